@@ -3,25 +3,90 @@ FastAPI wrapper that provides OpenAI-compatible API for the Hypothesis Generator
 This allows the agent to work with OpenAI's ChatKit.js frontend.
 """
 
-import os
-import json
+import sys
 import time
+import queue
+import atexit
 import asyncio
-from typing import Optional, AsyncGenerator
+import logging
+import logging.handlers
+from contextlib import asynccontextmanager
+from typing import Optional, AsyncGenerator, Any, Callable, Coroutine
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
 from pydantic import BaseModel, Field
-from dotenv import load_dotenv
+import orjson
+from sse_starlette.sse import EventSourceResponse
 
-from openai_agent import OpenAIAgentWrapper
-from tools import literature_agent
-from context import hypothesis_generator_instructions, ResearchContext
-from backend_utils import create_model, save_session
+from openai_agent import (build_generator_agent, TYPE_TEXT, TYPE_TOOL_CALL,
+                          TYPE_HYPOTHESIS_FOUND, TYPE_EXTRACTION_COMPLETE)
+from context import ResearchContext
+from backend_utils import create_model, save_session, save_session_msgpack
+from config import get_settings
 
-load_dotenv()
+settings = get_settings()
 
-app = FastAPI()
+
+# Backend loggers that follow LOG_LEVEL; everything else (httpx, openai, ...) stays at WARNING
+_APP_LOGGERS = (__name__, "openai_agent", "backend_utils", "tools")
+
+
+def _configure_logging():
+    """Send log records through a queue so stdout writes happen on a listener thread, not the event loop."""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+    )
+    for name in _APP_LOGGERS:
+        logging.getLogger(name).setLevel(settings.log_level or "INFO")
+    listener.start()
+    atexit.register(listener.stop)
+
+
+logger = logging.getLogger(__name__)
+
+
+class ORJSONRequest(Request):
+    """Request whose JSON body is decoded with orjson instead of stdlib json."""
+    
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError, so FastAPI's
+            # invalid-JSON handling still applies
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+
+class ORJSONRoute(APIRoute):
+    """Route class that hands endpoints an ORJSONRequest; Pydantic v2 then validates the parsed body."""
+    
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        original_route_handler = super().get_route_handler()
+        
+        async def route_handler(request: Request) -> Response:
+            return await original_route_handler(ORJSONRequest(request.scope, request.receive))
+        
+        return route_handler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Per-process startup: logging and the agent are set up once in each worker, not at import."""
+    global agent
+    _configure_logging()
+    agent = create_agent()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = ORJSONRoute
 
 # Configure CORS for local development
 app.add_middleware(
@@ -49,30 +114,41 @@ class ChatCompletionRequest(BaseModel):
 
 # Initialize agent
 def create_agent():
-    provider = os.getenv("MODEL_PROVIDER", "openai")
+    provider = settings.provider
     
     if provider == "openai":
-        model_name = os.getenv("OPENAI_MODEL_NAME", "gpt-4")
+        model_name = settings.openai_model or "gpt-4"
     else:
-        model_name = os.getenv("OPENROUTER_MODEL_NAME")
+        model_name = settings.openrouter_model
     
     hypothesis_model = create_model(provider, model_name)
     
-    return OpenAIAgentWrapper(
-        name="Hypothesis Generator Agent",
-        instructions=hypothesis_generator_instructions,
-        tools=[literature_agent.as_tool(
-            tool_name="literature_search",
-            tool_description="Search for academic and scholarly information"
-        )],
-        model=hypothesis_model
-    )
+    return build_generator_agent(hypothesis_model, name="Hypothesis Generator Agent")
+
+# Built by lifespan() at worker startup, so importing this module has no side effects
+agent = None
 
-agent = create_agent()
+# Text deltas are flushed to the client every N deltas, or once the oldest buffered
+# delta is this many seconds old (a timer, so pauses before tool calls don't hold text back)
+COALESCE_MAX_DELTAS = 16
+COALESCE_INTERVAL_S = 0.02
+
+# Keep-alive comment interval so proxies don't drop idle streams during long tool calls
+SSE_PING_INTERVAL_S = 15
+
+# Pending background session saves
+_background_tasks: set[asyncio.Task] = set()
+
+def _sse_frame(obj) -> bytes:
+    """Serialize an SSE payload with orjson straight into a ready-to-send bytes frame."""
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
+
+# Health payload never changes, so serialize it once
+_HEALTHY = b'{"status":"healthy"}'
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy"}
+    return Response(content=_HEALTHY, media_type="application/json")
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: ChatCompletionRequest):
@@ -81,19 +157,18 @@ async def chat_completions(request: ChatCompletionRequest):
     Translates between OpenAI's format and your agent's format.
     """
     
-    # Extract the user's message
-    user_message = ""
-    for msg in request.messages:
-        if msg.role == "user":
-            user_message = msg.content
-            break
+    # Extract the latest user message (scan from the end of the chat history)
+    user_message = next((msg.content for msg in reversed(request.messages) if msg.role == "user"), "")
     
     if not user_message:
         raise HTTPException(status_code=400, detail="No user message found")
     
-    # Extract metadata for context
-    domain = request.metadata.get("domain", "AI for Drug Discovery")
-    num_hypotheses = request.metadata.get("num_hypotheses", 3)
+    # Extract metadata for context; coerced to str/int since the prompt renderer caches on them
+    domain = str(request.metadata.get("domain", "AI for Drug Discovery"))
+    try:
+        num_hypotheses = int(request.metadata.get("num_hypotheses", 3))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="metadata.num_hypotheses must be an integer")
     
     context = ResearchContext(
         problem_space_title=domain,
@@ -104,21 +179,21 @@ async def chat_completions(request: ChatCompletionRequest):
     prompt = f"Please generate hypotheses for the following research idea: {user_message}"
     
     if request.stream:
-        return StreamingResponse(
+        # EventSourceResponse sets the no-cache / X-Accel-Buffering headers and sends
+        # keep-alive pings; our pre-framed bytes are passed through unchanged
+        return EventSourceResponse(
             generate_stream(prompt, context),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "X-Accel-Buffering": "no",  # Disable nginx buffering
-            }
+            ping=SSE_PING_INTERVAL_S,
+            sep="\n",
         )
     else:
-        # Non-streaming response
+        # Non-streaming response, pre-serialized with orjson so FastAPI skips jsonable_encoder
         response = await agent.run(prompt, context=context)
-        return {
-            "id": f"chatcmpl-{int(time.time())}",
+        created = int(time.time())
+        payload = {
+            "id": f"chatcmpl-{created}",
             "object": "chat.completion",
-            "created": int(time.time()),
+            "created": created,
             "model": request.model,
             "choices": [{
                 "index": 0,
@@ -134,26 +209,39 @@ async def chat_completions(request: ChatCompletionRequest):
                 "total_tokens": 0
             }
         }
+        return Response(content=orjson.dumps(payload), media_type="application/json")
 
-async def generate_stream(prompt: str, context: ResearchContext) -> AsyncGenerator[str, None]:
+async def generate_stream(prompt: str, context: ResearchContext) -> AsyncGenerator[bytes, None]:
     """
     Generate OpenAI-compatible SSE stream from agent output.
     """
     
     # Initialize session tracking variables
-    raw_output = ""
+    raw_output_parts: list[str] = []  # Joined once at the end (avoids O(N^2) str +=)
     extracted_hypotheses = []
     extraction_stats = {}
     tool_interactions = []
     
-    # Send initial stream chunk
-    chunk_id = f"chatcmpl-{int(time.time())}"
+    # Sample id/timestamp once per stream; every chunk shares them
+    created = int(time.time())
+    chunk_id = f"chatcmpl-{created}"
+    
+    # Content chunks only differ in delta.content, so build the framing once
+    # and splice the JSON-escaped content between prefix and suffix
+    frame_prefix = (
+        f'data: {{"id":"{chunk_id}","object":"chat.completion.chunk","created":{created},'
+        '"model":"hypothesis-generator","choices":[{"index":0,"delta":{"content":'
+    ).encode()
+    frame_suffix = b'},"finish_reason":null}]}\n\n'
+    
+    def content_frame(content: str) -> bytes:
+        return frame_prefix + orjson.dumps(content) + frame_suffix
     
     # Initial chunk
     initial_chunk = {
         "id": chunk_id,
         "object": "chat.completion.chunk",
-        "created": int(time.time()),
+        "created": created,
         "model": "hypothesis-generator",
         "choices": [{
             "index": 0,
@@ -161,91 +249,96 @@ async def generate_stream(prompt: str, context: ResearchContext) -> AsyncGenerat
             "finish_reason": None
         }]
     }
-    yield f"data: {json.dumps(initial_chunk)}\n\n"
+    yield _sse_frame(initial_chunk)
     
-    # Stream content from agent with hypothesis extraction
-    async for event in agent.run_stream_with_extraction(prompt=prompt, context=context):
-        if event["type"] == "text":
-            # Collect raw output for session saving
-            raw_output += event["data"]
+    # Text deltas are coalesced so each SSE frame carries several tokens
+    loop = asyncio.get_running_loop()
+    pending_text = []
+    pending_since = 0.0
+    
+    # Stream content from agent with hypothesis extraction. While text is buffered the
+    # next event is awaited as a task with a timeout, so the buffer is flushed on time
+    # even when the model pauses; the task is kept (not cancelled) across timeouts.
+    events = agent.run_stream_with_extraction(prompt=prompt, context=context)
+    next_event = None
+    try:
+        while True:
+            if pending_text:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(anext(events))
+                remaining = COALESCE_INTERVAL_S - (loop.time() - pending_since)
+                if remaining <= 0 or not (await asyncio.wait((next_event,), timeout=remaining))[0]:
+                    yield content_frame("".join(pending_text))
+                    pending_text.clear()
+                    continue
+            try:
+                if next_event is not None:
+                    event_type, data, extra = await next_event
+                else:
+                    event_type, data, extra = await anext(events)
+            except StopAsyncIteration:
+                break
+            finally:
+                next_event = None
             
-            # Stream text chunks in OpenAI format
-            chunk = {
-                "id": chunk_id,
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": "hypothesis-generator",
-                "choices": [{
-                    "index": 0,
-                    "delta": {"content": event["data"]},
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
+            if event_type == TYPE_TEXT:
+                # Collect raw output for session saving
+                raw_output_parts.append(data)
+                
+                # Stream text chunks in OpenAI format once enough has accumulated
+                if not pending_text:
+                    pending_since = loop.time()
+                pending_text.append(data)
+                if len(pending_text) >= COALESCE_MAX_DELTAS:
+                    yield content_frame("".join(pending_text))
+                    pending_text.clear()
+                continue
             
-        elif event["type"] == "tool_call":
-            # Optional: Send tool call info as a system message
-            chunk = {
-                "id": chunk_id,
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": "hypothesis-generator",
-                "choices": [{
-                    "index": 0,
-                    "delta": {"content": f"\n[{event['data']}]\n"},
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
-        
-        elif event["type"] == "hypothesis_found":
-            # Collect extracted hypothesis for session saving
-            extracted_hypotheses.append(event["data"])
+            # Flush buffered text before any other event to preserve ordering
+            if pending_text:
+                yield content_frame("".join(pending_text))
+                pending_text.clear()
             
-            # Send hypothesis extraction event to frontend
-            chunk = {
-                "id": chunk_id,
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": "hypothesis-generator",
-                "choices": [{
-                    "index": 0,
-                    "delta": {"content": f"\n[HYPOTHESIS {event['progress']} EXTRACTED]\n{event['summary']}\n"},
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
-            
-        elif event["type"] == "extraction_complete":
-            # Collect extraction stats and tool interactions for session saving
-            extraction_stats = {
-                "total_extracted": event.get('total_hypotheses', 0),
-                "expected": event.get('expected', None),
-                "extraction_time": time.time(),
-                "message": event.get('message', '')
-            }
-            # Collect tool interactions for enhanced logging
-            tool_interactions = event.get('tool_interactions', [])
+            if event_type == TYPE_TOOL_CALL:
+                # Optional: Send tool call info as a system message
+                yield content_frame(f"\n[{data}]\n")
             
-            # Send extraction summary to frontend
-            chunk = {
-                "id": chunk_id,
-                "object": "chat.completion.chunk", 
-                "created": int(time.time()),
-                "model": "hypothesis-generator",
-                "choices": [{
-                    "index": 0,
-                    "delta": {"content": f"\n=== EXTRACTION COMPLETE ===\n{event['message']}\n"},
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
+            elif event_type == TYPE_HYPOTHESIS_FOUND:
+                # Collect extracted hypothesis for session saving
+                extracted_hypotheses.append(data)
+                
+                # Send hypothesis extraction event to frontend
+                yield content_frame(f"\n[HYPOTHESIS {extra['progress']} EXTRACTED]\n{extra['summary']}\n")
+                
+            elif event_type == TYPE_EXTRACTION_COMPLETE:
+                # Collect extraction stats and tool interactions for session saving
+                extraction_stats = {
+                    "total_extracted": extra.get('total_hypotheses', 0),
+                    "expected": extra.get('expected', None),
+                    "extraction_time": time.time(),
+                    "message": data
+                }
+                # Collect tool interactions for enhanced logging
+                tool_interactions = extra.get('tool_interactions', [])
+                
+                # Send extraction summary to frontend
+                yield content_frame(f"\n=== EXTRACTION COMPLETE ===\n{data}\n")
+    finally:
+        # Client went away mid-stream: stop the pending read and close the agent stream
+        if next_event is not None:
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+        await events.aclose()
+    
+    # Flush any text still buffered
+    if pending_text:
+        yield content_frame("".join(pending_text))
     
     # Send final chunk
     final_chunk = {
         "id": chunk_id,
         "object": "chat.completion.chunk",
-        "created": int(time.time()),
+        "created": created,
         "model": "hypothesis-generator",
         "choices": [{
             "index": 0,
@@ -253,51 +346,74 @@ async def generate_stream(prompt: str, context: ResearchContext) -> AsyncGenerat
             "finish_reason": "stop"
         }]
     }
-    yield f"data: {json.dumps(final_chunk)}\n\n"
+    yield _sse_frame(final_chunk)
     
     # Send [DONE] marker
-    yield "data: [DONE]\n\n"
+    yield b"data: [DONE]\n\n"
     
-    # Save session data after streaming completes
-    try:
-        # Extract metadata from context
-        domain = context.problem_space_title
-        num_hypotheses = context.number_of_hypothesis
-        
-        # Get provider/model info from environment
-        provider = os.getenv("MODEL_PROVIDER", "openai")
-        if provider == "openai":
-            model_name = os.getenv("OPENAI_MODEL_NAME", "gpt-4")
-        else:
-            model_name = os.getenv("OPENROUTER_MODEL_NAME", "unknown")
-        
-        # Use the prompt as research_idea (best we can extract from API request)
-        research_idea = prompt.replace("Please generate hypotheses for the following research idea: ", "")
-        
-        session_file = save_session(
-            domain=domain,
-            num_hypotheses=num_hypotheses,
-            research_idea=research_idea,
-            provider=provider,
-            model_name=model_name,
-            raw_output=raw_output,
-            extracted_hypotheses=extracted_hypotheses,
-            extraction_stats=extraction_stats,
-            tool_interactions=tool_interactions  # NEW: Pass tool interaction data
-        )
+    # Save session data in a background thread so the disk write doesn't hold
+    # the connection open after [DONE]
+    # Extract metadata from context
+    domain = context.problem_space_title
+    num_hypotheses = context.number_of_hypothesis
+    
+    # Get provider/model info from environment
+    provider = settings.provider
+    if provider == "openai":
+        model_name = settings.openai_model or "gpt-4"
+    else:
+        model_name = settings.openrouter_model or "unknown"
+    
+    # Use the prompt as research_idea (best we can extract from API request)
+    research_idea = prompt.replace("Please generate hypotheses for the following research idea: ", "")
+    
+    # Snapshot collected data by value before handing it to the worker thread
+    raw_output = "".join(raw_output_parts)
+    extracted_hypotheses = list(extracted_hypotheses)
+    tool_interactions = list(tool_interactions)
+    
+    def on_session_saved(task: asyncio.Task):
+        _background_tasks.discard(task)
+        try:
+            session_file = task.result()
+        except Exception as e:
+            # Log error but don't break the API response
+            logger.warning("Failed to save API session: %s", e)
+            logger.warning("Session data: %d chars, %d hypotheses, %d tool calls",
+                           len(raw_output), len(extracted_hypotheses), len(tool_interactions))
+            return
         
         # Log successful save (optional - won't reach frontend)
-        print(f"API session saved: {session_file}")
-        print(f"Extracted {len(extracted_hypotheses)}/{num_hypotheses} hypotheses")
-        print(f"Tool interactions: {len(tool_interactions)}")
-        
-    except Exception as e:
-        # Log error but don't break the API response
-        print(f"Warning: Failed to save API session: {e}")
-        print(f"Session data: {len(raw_output)} chars, {len(extracted_hypotheses)} hypotheses, {len(tool_interactions)} tool calls")
+        logger.info("API session saved: %s", session_file)
+        logger.info("Extracted %d/%s hypotheses", len(extracted_hypotheses), num_hypotheses)
+        logger.info("Tool interactions: %d", len(tool_interactions))
+    
+    # SESSION_FORMAT=msgpack writes compact binary archives instead of indented JSON
+    writer = save_session_msgpack if settings.session_format == "msgpack" else save_session
+    
+    task = asyncio.create_task(asyncio.to_thread(
+        writer,
+        domain=domain,
+        num_hypotheses=num_hypotheses,
+        research_idea=research_idea,
+        provider=provider,
+        model_name=model_name,
+        raw_output=raw_output,
+        extracted_hypotheses=extracted_hypotheses,
+        extraction_stats=dict(extraction_stats),
+        tool_interactions=tool_interactions  # NEW: Pass tool interaction data
+    ))
+    # Keep a strong reference until the save finishes (the loop only holds weak refs)
+    _background_tasks.add(task)
+    task.add_done_callback(on_session_saved)
 
 if __name__ == "__main__":
     import uvicorn
     print("Starting Hypothesis Generator API on http://localhost:8000")
     print("OpenAI-compatible endpoint: POST http://localhost:8000/v1/chat/completions")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Multiple workers need the app passed as an import string; a single worker gets the
+    # app object so this module isn't imported a second time. uvicorn[standard] picks
+    # uvloop and httptools automatically when they are installed
+    workers = settings.uvicorn_workers
+    print(f"Workers: {workers}")
+    uvicorn.run(app if workers == 1 else "app:app", host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
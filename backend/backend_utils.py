@@ -1,113 +1,242 @@
-import os
 import re
-import json
+import logging
+import functools
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any
-from dotenv import load_dotenv
+from typing import List, Dict, Any, Optional
+import orjson
+import msgpack
 from agents import OpenAIChatCompletionsModel
 from openai import AsyncOpenAI
+from config import get_settings
 
-def create_model(provider="openai", model_name=None):
+logger = logging.getLogger(__name__)
+
+# Opening fence of the ```json ... ``` blocks emitted by the hypothesis generator
+_FENCE_OPEN = "```json"
+
+# Fields every extracted hypothesis must carry
+_REQUIRED_FIELDS = frozenset(['claim', 'dataset', 'metric', 'baseline',
+                              'success_threshold', 'budget', 'reasoning', 'citations'])
+
+# Chat-completions model wrappers built so far, keyed by (provider, model_name)
+_model_cache: Dict[tuple, OpenAIChatCompletionsModel] = {}
+
+
+@functools.lru_cache(maxsize=8)
+def _get_openai_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    """Return a shared AsyncOpenAI client so its HTTP connection pool stays warm across agents."""
+    return AsyncOpenAI(base_url=base_url, api_key=api_key)
+
+
+def create_model(provider="openai", model_name=None, announce=True):
     """
     Create model object based on provider and model name.
     
+    Model objects (and their underlying client) are cached, so repeated calls
+    for the same provider/model reuse warmed connections.
+    
     Args:
         provider: Either "openai" (default) or "openrouter"
         model_name: Model identifier
+        announce: Print the "Using ... model" banner (off for background warm-up)
     
     Returns:
         Model object or model name string
     """
+    settings = get_settings()
     if provider == "openrouter":
 
-        openrouter_key = os.getenv("OPENROUTER_API_KEY")
+        openrouter_key = settings.openrouter_api_key
         if not openrouter_key:
             raise ValueError("OPENROUTER_API_KEY environment variable is required for OpenRouter")
         
         if not model_name:
-            model_name = os.getenv("OPENROUTER_MODEL_NAME", "anthropic/claude-3.5-sonnet")
-            
-        model_obj = OpenAIChatCompletionsModel(
-            model=model_name,
-            openai_client=AsyncOpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=openrouter_key,
-            ),
-        )
-        print(f"✅ Using OpenRouter model: {model_name}")
+            model_name = settings.openrouter_model or "anthropic/claude-3.5-sonnet"
+        
+        model_obj = _model_cache.get((provider, model_name))
+        if model_obj is None:
+            model_obj = OpenAIChatCompletionsModel(
+                model=model_name,
+                openai_client=_get_openai_client("https://openrouter.ai/api/v1", openrouter_key),
+            )
+            _model_cache[(provider, model_name)] = model_obj
+        if announce:
+            print(f"✅ Using OpenRouter model: {model_name}")
         return model_obj
     else:
         # For OpenAI, just return the model name string
         if not model_name:
-            model_name = os.getenv("OPENAI_MODEL_NAME", "gpt-5")
-        print(f"✅ Using OpenAI model: {model_name}")
+            model_name = settings.openai_model or "gpt-5"
+        if announce:
+            print(f"✅ Using OpenAI model: {model_name}")
         return model_name
 
 
-def extract_hypotheses(buffer: str) -> List[Dict[str, Any]]:
+def _validate_hypothesis(item: Dict[str, Any]) -> bool:
+    """Check that a parsed object carries every required hypothesis field."""
+    # Subset test against the keys view runs as a C-level set operation
+    if _REQUIRED_FIELDS <= item.keys():
+        return True
+    # Log validation failure; the difference is only computed here
+    logger.warning("Hypothesis missing fields: %s", sorted(_REQUIRED_FIELDS - item.keys()))
+    return False
+
+
+class HypothesisStreamParser:
     """
-    Extract all complete hypothesis JSON blocks from text buffer.
-    Handles both single hypothesis objects and arrays of hypotheses.
+    Incremental extractor for hypotheses streamed inside ```json fences.
     
-    Args:
-        buffer: Text buffer that may contain ```json...``` blocks
-        
-    Returns:
-        List of validated hypothesis dictionaries
+    Feed it text deltas in order; it keeps a single scan state across calls
+    (fence, brace depth, string/escape flags and the open object's text) so each
+    character is examined once. Deltas without a closing brace are only queued,
+    and scanning catches up when one arrives, so a hypothesis is still returned
+    the moment the closing brace of its top-level object streams in, whether the
+    block holds a single object or an array of them.
     """
-    # Regex to capture content between ```json and ```
-    pattern = r'```json\s*(.*?)\s*```'
-    matches = re.findall(pattern, buffer, re.DOTALL)
     
-    hypotheses = []
-    for match in matches:
-        try:
-            # Parse JSON
-            parsed = json.loads(match.strip())
+    # Characters that change parser state inside a fence
+    _SPECIAL = re.compile(r'[{}"\\`]')
+    
+    def __init__(self):
+        self.count = 0          # Hypotheses emitted so far (used for _id)
+        self._in_fence = False
+        self._tail = ""         # Unscanned text that may hold a split opening fence
+        self._depth = 0         # Brace depth inside the current fence
+        self._in_string = False
+        self._escape = False    # Previous character was a backslash inside a string
+        self._obj_parts = []    # Text of the top-level object being read
+        self._deferred = []     # Deltas received since the last closing brace, not yet scanned
+    
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """
+        Consume the next text delta.
+        
+        Args:
+            chunk: Newly streamed text
             
-            # Handle both single hypothesis and array of hypotheses
-            if isinstance(parsed, list):
-                # It's an array of hypotheses
-                items = parsed
-            elif isinstance(parsed, dict):
-                # It's a single hypothesis
-                items = [parsed]
-            else:
+        Returns:
+            List of validated hypotheses completed by this chunk (usually empty)
+        """
+        # An object can only complete on a closing brace; until one arrives just queue the delta
+        if "}" not in chunk:
+            self._deferred.append(chunk)
+            return []
+        if self._deferred:
+            self._deferred.append(chunk)
+            chunk = "".join(self._deferred)
+            self._deferred = []
+        
+        hypotheses = []
+        text = chunk
+        while text:
+            if not self._in_fence:
+                # Look for an opening fence, allowing for one split across deltas
+                text = self._tail + text
+                open_idx = text.find(_FENCE_OPEN)
+                if open_idx == -1:
+                    self._tail = text[-(len(_FENCE_OPEN) - 1):]
+                    break
+                self._tail = ""
+                self._in_fence = True
+                text = text[open_idx + len(_FENCE_OPEN):]
+            text = self._scan_fence(text, hypotheses)
+        return hypotheses
+    
+    def _scan_fence(self, text: str, hypotheses: List[Dict[str, Any]]) -> str:
+        """Scan text inside a fence; return whatever follows a closing fence."""
+        obj_start = 0 if self._depth else None
+        # An escape split across deltas consumes this chunk's first character
+        skip_to = 1 if self._escape else 0
+        self._escape = False
+        for match in self._SPECIAL.finditer(text):
+            idx = match.start()
+            if idx < skip_to:
                 continue
-            
-            # Validate required fields for each hypothesis
-            required_fields = ['claim', 'dataset', 'metric', 'baseline', 
-                             'success_threshold', 'budget', 'reasoning', 'citations']
-            
-            for item in items:
-                if all(field in item for field in required_fields):
-                    # Add metadata for tracking
-                    item['_extracted'] = True
-                    item['_id'] = len(hypotheses) + 1
-                    hypotheses.append(item)
-                else:
-                    # Log validation failure (optional)
-                    missing = [f for f in required_fields if f not in item]
-                    if missing:
-                        print(f"Hypothesis missing fields: {missing}")
-                    
-        except json.JSONDecodeError as e:
-            # Silently skip malformed JSON (or optionally log)
-            print(f"Failed to parse hypothesis JSON: {e}")
-            continue
-        except Exception as e:
-            # Catch any other unexpected errors
-            print(f"Error processing hypothesis: {e}")
-            continue
-    
-    return hypotheses
+            char = match.group()
+            if self._in_string:
+                if char == '\\':
+                    if idx + 1 < len(text):
+                        skip_to = idx + 2
+                    else:
+                        self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                if self._depth == 0:
+                    obj_start = idx
+                self._depth += 1
+            elif char == '}':
+                if self._depth == 0:
+                    continue
+                self._depth -= 1
+                if self._depth == 0:
+                    self._obj_parts.append(text[obj_start:idx + 1])
+                    self._emit("".join(self._obj_parts), hypotheses)
+                    self._obj_parts = []
+                    obj_start = None
+            elif self._depth == 0:
+                # Backtick outside any object or string closes the fence
+                self._in_fence = False
+                return text[idx:].lstrip('`')
+        
+        if obj_start is not None:
+            self._obj_parts.append(text[obj_start:])
+        return ""
+    
+    def _emit(self, obj_text: str, hypotheses: List[Dict[str, Any]]) -> None:
+        """Parse and validate a completed object, appending it if it is a hypothesis."""
+        try:
+            item = orjson.loads(obj_text)
+        except orjson.JSONDecodeError as e:
+            logger.warning("Failed to parse hypothesis JSON: %s", e)
+            return
+        if _validate_hypothesis(item):
+            self.count += 1
+            item['_extracted'] = True
+            item['_id'] = self.count
+            hypotheses.append(item)
+
+
+def _build_session_data(domain: str, num_hypotheses: int, research_idea: str,
+                        provider: str, model_name: str, raw_output: str,
+                        extracted_hypotheses: list, extraction_stats: dict,
+                        tool_interactions: list = None,
+                        raw_output_path: Optional[str] = None) -> Dict[str, Any]:
+    """Assemble the session record shared by the JSON and msgpack writers."""
+    if raw_output_path is not None:
+        # Raw output was spooled to disk while streaming; read it back only now
+        raw_output = Path(raw_output_path).read_text(encoding="utf-8")
+    
+    # Generate session ID from timestamp and domain
+    timestamp = datetime.now()
+    domain_slug = domain.replace(" ", "-").replace("/", "-")[:30]
+    session_id = f"{timestamp.strftime('%Y-%m-%d_%H-%M-%S')}_{domain_slug}"
+    
+    return {
+        "session_id": session_id,
+        "timestamp": timestamp,  # orjson serializes datetime natively (ISO 8601)
+        "metadata": {
+            "domain": domain,
+            "num_requested": num_hypotheses,
+            "model_provider": provider,
+            "model_name": model_name
+        },
+        "research_idea": research_idea,
+        "raw_output": raw_output,
+        "extracted_hypotheses": extracted_hypotheses,
+        "extraction_stats": extraction_stats,
+        "tool_interactions": tool_interactions or []  # NEW: Complete tool interaction data
+    }
 
 
 def save_session(domain: str, num_hypotheses: int, research_idea: str, 
                 provider: str, model_name: str, raw_output: str, 
                 extracted_hypotheses: list, extraction_stats: dict,
-                tool_interactions: list = None) -> str:
+                tool_interactions: list = None,
+                raw_output_path: Optional[str] = None) -> str:
     """
     Save complete session data to JSON file.
     
@@ -121,6 +250,7 @@ def save_session(domain: str, num_hypotheses: int, research_idea: str,
         extracted_hypotheses: List of extracted hypothesis dictionaries
         extraction_stats: Stats from extraction process
         tool_interactions: List of complete tool interaction data (optional)
+        raw_output_path: File holding the raw output, read instead of raw_output (optional)
         
     Returns:
         Path to saved session file
@@ -129,31 +259,49 @@ def save_session(domain: str, num_hypotheses: int, research_idea: str,
     sessions_dir = Path("sessions")
     sessions_dir.mkdir(exist_ok=True)
     
-    # Generate session ID from timestamp and domain
-    timestamp = datetime.now()
-    domain_slug = domain.replace(" ", "-").replace("/", "-")[:30]
-    session_id = f"{timestamp.strftime('%Y-%m-%d_%H-%M-%S')}_{domain_slug}"
+    session_data = _build_session_data(
+        domain, num_hypotheses, research_idea, provider, model_name, raw_output,
+        extracted_hypotheses, extraction_stats, tool_interactions, raw_output_path
+    )
     
-    # Build session data
-    session_data = {
-        "session_id": session_id,
-        "timestamp": timestamp.isoformat(),
-        "metadata": {
-            "domain": domain,
-            "num_requested": num_hypotheses,
-            "model_provider": provider,
-            "model_name": model_name
-        },
-        "research_idea": research_idea,
-        "raw_output": raw_output,
-        "extracted_hypotheses": extracted_hypotheses,
-        "extraction_stats": extraction_stats,
-        "tool_interactions": tool_interactions or []  # NEW: Complete tool interaction data
-    }
+    # Save to file (serialized in C by orjson and written as a single buffer)
+    session_file = sessions_dir / f"{session_data['session_id']}.json"
+    with open(session_file, 'wb') as f:
+        f.write(orjson.dumps(session_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    
+    return str(session_file)
+
+
+def _msgpack_default(obj):
+    """Encode types msgpack doesn't handle natively (naive datetimes as ISO 8601, like the JSON writer)."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+def save_session_msgpack(domain: str, num_hypotheses: int, research_idea: str,
+                         provider: str, model_name: str, raw_output: str,
+                         extracted_hypotheses: list, extraction_stats: dict,
+                         tool_interactions: list = None,
+                         raw_output_path: Optional[str] = None) -> str:
+    """
+    Save complete session data as a compact msgpack archive.
+    
+    Takes the same arguments as save_session. The binary file is smaller and
+    faster to reload for batch analysis; load it with msgpack.unpackb(data, raw=False).
+    
+    Returns:
+        Path to saved session file
+    """
+    sessions_dir = Path("sessions")
+    sessions_dir.mkdir(exist_ok=True)
+    
+    session_data = _build_session_data(
+        domain, num_hypotheses, research_idea, provider, model_name, raw_output,
+        extracted_hypotheses, extraction_stats, tool_interactions, raw_output_path
+    )
     
-    # Save to file
-    session_file = sessions_dir / f"{session_id}.json"
-    with open(session_file, 'w', encoding='utf-8') as f:
-        json.dump(session_data, f, indent=2, ensure_ascii=False)
+    session_file = sessions_dir / f"{session_data['session_id']}.msgpack"
+    session_file.write_bytes(msgpack.packb(session_data, use_bin_type=True, default=_msgpack_default))
     
-    return str(session_file)
\ No newline at end of file
+    return str(session_file)
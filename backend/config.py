@@ -0,0 +1,55 @@
+"""
+Application settings, read from the environment (and backend/.env) once per process.
+"""
+
+import os
+import functools
+from dataclasses import dataclass
+from typing import Optional
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Snapshot of the environment configuration (see .env.example).
+
+    Model names and the log level are None when unset, so each entry point can keep its
+    own default.
+    """
+    provider: str
+    openrouter_api_key: Optional[str]
+    openai_model: Optional[str]
+    openrouter_model: Optional[str]
+    openai_fast_model: Optional[str]
+    openrouter_fast_model: Optional[str]
+    literature_model: str
+    literature_cache: bool
+    literature_cache_threshold: float
+    literature_cache_max_age_days: float
+    session_format: str
+    uvicorn_workers: int
+    batch_concurrency: int
+    log_level: Optional[str]
+
+
+@functools.cache
+def get_settings() -> Settings:
+    """Load backend/.env and snapshot the settings the first time any module asks for them."""
+    load_dotenv()
+    getenv = os.getenv
+    return Settings(
+        provider=getenv("MODEL_PROVIDER", "openai"),
+        openrouter_api_key=getenv("OPENROUTER_API_KEY"),
+        openai_model=getenv("OPENAI_MODEL_NAME"),
+        openrouter_model=getenv("OPENROUTER_MODEL_NAME"),
+        openai_fast_model=getenv("OPENAI_FAST_MODEL_NAME"),
+        openrouter_fast_model=getenv("OPENROUTER_FAST_MODEL_NAME"),
+        literature_model=getenv("LITERATURE_SEARCH_MODEL", "gpt-5"),
+        literature_cache=getenv("LITERATURE_CACHE", "off") == "on",
+        literature_cache_threshold=float(getenv("LITERATURE_CACHE_THRESHOLD", "0.92")),
+        literature_cache_max_age_days=float(getenv("LITERATURE_CACHE_MAX_AGE_DAYS", "7")),
+        session_format=getenv("SESSION_FORMAT", "json"),
+        uvicorn_workers=int(getenv("UVICORN_WORKERS", "1")),
+        batch_concurrency=int(getenv("BATCH_CONCURRENCY", "5")),
+        log_level=getenv("LOG_LEVEL"),
+    )
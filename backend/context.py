@@ -2,30 +2,25 @@
 Context definitions and dynamic instruction generators for agents.
 """
 
+import string
+import functools
 from dataclasses import dataclass
 from typing import Optional, List, Dict, Any
 from agents import Agent, RunContextWrapper
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ResearchContext:
-    """Context for research hypothesis generation."""
+    """Context for research hypothesis generation (immutable, slotted for cheap per-request construction)."""
     problem_space_title: str
     number_of_hypothesis: int
     
 
-def hypothesis_generator_instructions(
-    run_context: RunContextWrapper[ResearchContext], 
-    agent: Agent[ResearchContext]
-) -> str:
-    """
-    Generate dynamic instructions for the hypothesis generator agent.
-    """
-    ctx = run_context.context
-    
-    prompt = f"""You are an AI Researcher working on a novel research idea in {ctx.problem_space_title}.
+# Hypothesis generator prompt as a str.format template; {title} and {count} are
+# the only dynamic values
+_PROMPT_TEMPLATE = """You are an AI Researcher working on a novel research idea in {title}.
 
-Your task is to generate {ctx.number_of_hypothesis} hypotheses for meaningful contributions to {ctx.problem_space_title} in AI/ML.
+Your task is to generate {count} hypotheses for meaningful contributions to {title} in AI/ML.
 
 ## Output Format
 
@@ -55,11 +50,12 @@ Each hypothesis must be in the following JSON format:
 ## Tools Available
 To do this you have the following tools available to you: 
 1. literature_search = An academic research assistant agent that searches for scholarly articles and academic information to answer your queries with detailed citations.Please note that while using this tool, phrase your queries as detailed questions for better responses.
+2. literature_search_batch = The same research assistant, but takes a list of queries and runs them all concurrently, returning one answer section per query. Use it whenever you have several independent questions (e.g. dataset, baseline and metric checks for a hypothesis).
 
 ## Critical Hypotheses Generation Guidelines
 
 1. **Live uncertainty & decision relevance**
-   Each hypothesis must target a live uncertainty in {ctx.problem_space_title} and **briefly state why the result would be decision-relevant**.
+   Each hypothesis must target a live uncertainty in {title} and **briefly state why the result would be decision-relevant**.
 
 2. **Web-grounding (literature_search)**
    Use **literature_search** tool liberally to surface the most recent (2025) information: **datasets**, **baselines**, and both **evaluation metrics** **and process/ops metrics**. Also use it to identify what the {{`problem_space_title`}} community cares most about and current frontiers. Include citations from the tool.
@@ -94,8 +90,8 @@ To do this you have the following tools available to you:
 ## Process
 
 1. Start with detailing your understading of the research idea shared at the start of your process.
-2. List all the high level details you must gather for a holistic understanding of what already exists related to the research idea in {ctx.problem_space_title}. 
-3. Identify additional hypotheses required toward the end goal of a meaningful contribution as specified before. For each desired {ctx.number_of_hypothesis} hypotheses (the working loop):
+2. List all the high level details you must gather for a holistic understanding of what already exists related to the research idea in {title}. 
+3. Identify additional hypotheses required toward the end goal of a meaningful contribution as specified before. For each desired {count} hypotheses (the working loop):
 • Draft the claim, anchored to the idea shared.
 • literature_search (liberally) to verify dataset and baseline availability and to identify both evaluation metrics and process/ops metrics commonly reported for this task. Capture citations.
 • literature_search to confirm a concrete dataset release/version, splits, and size; capture citations.
@@ -110,6 +106,57 @@ Hypotheses must differ on ≥ 1 axis in objective, model component, data, evalua
 ## Tool Use Reminders
 1. Keep literature_search substantive, not spammy - Perform at least 5 substantive literature_search queries to understand the problem and idea space and at least 3 literature_search queries per hypothesis where needed to establish datasets, baselines, and both evaluation and process metrics; avoid redundant queries once evidence is sufficient.
 2. Always phrase literature_search queries as detailed questions to get the best results. The tool provides academic-literature grounded answers with citations.
+3. Prefer batching independent queries into one literature_search_batch call instead of issuing them one after another; batched queries count toward the query minimums above.
 """
-    
-    return prompt
\ No newline at end of file
+
+# Sentinels marking the dynamic slots in the pre-split prompt
+_TITLE = object()
+_COUNT = object()
+
+
+def _split_template(template: str) -> tuple:
+    """Split a str.format template once into literal fragments and slot sentinels."""
+    slots = {"title": _TITLE, "count": _COUNT}
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            parts.append(slots[field])
+    return tuple(parts)
+
+
+_PROMPT_PARTS = _split_template(_PROMPT_TEMPLATE)
+
+
+@functools.lru_cache(maxsize=32)
+def _title_segments(title: str) -> tuple:
+    """Substitute the title once and return the static text between the {count} slots."""
+    segments = []
+    current = []
+    for part in _PROMPT_PARTS:
+        if part is _COUNT:
+            segments.append("".join(current))
+            current = []
+        else:
+            current.append(title if part is _TITLE else part)
+    segments.append("".join(current))
+    return tuple(segments)
+
+
+@functools.lru_cache(maxsize=128)
+def _render_instructions(title: str, count: int) -> str:
+    """Render the prompt for one (title, count) pair; the output is deterministic, so it is memoized."""
+    # Only the count differs between renders for the same title, so reuse the per-title segments
+    return str(count).join(_title_segments(title))
+
+
+def hypothesis_generator_instructions(
+    run_context: RunContextWrapper[ResearchContext], 
+    agent: Agent[ResearchContext]
+) -> str:
+    """
+    Generate dynamic instructions for the hypothesis generator agent.
+    """
+    ctx = run_context.context
+    return _render_instructions(ctx.problem_space_title, ctx.number_of_hypothesis)
@@ -6,30 +6,264 @@ supporting both OpenAI and OpenRouter model providers with real-time streaming o
 """
 
 import os
-import json
+import sys
+import time
 import asyncio
+import itertools
+import logging
+import orjson
+import tempfile
+import hashlib
+import functools
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from dotenv import load_dotenv
-from agents import Agent, Runner, OpenAIChatCompletionsModel
-from tools import literature_agent
+from typing import Any, NamedTuple
+from agents import Agent, Runner, RunConfig, ModelSettings, ItemHelpers, OpenAIChatCompletionsModel
+from openai.types.responses import ResponseTextDeltaEvent
+from tools import cached_literature_search, literature_search_batch
 from context import hypothesis_generator_instructions, ResearchContext
-from backend_utils import create_model, save_session
+from backend_utils import create_model, save_session, save_session_msgpack, HypothesisStreamParser
+from config import get_settings
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
+# Stream event type constants
+TYPE_TEXT = "text"
+TYPE_TOOL_CALL = "tool_call"
+TYPE_TOOL_OUTPUT = "tool_output"
+TYPE_MESSAGE = "message"
+TYPE_HYPOTHESIS_FOUND = "hypothesis_found"
+TYPE_EXTRACTION_COMPLETE = "extraction_complete"
 
-class OpenAIAgentWrapper:
-    """Wrapper class for OpenAI Agent operations."""
+
+class StreamEvent(NamedTuple):
+    """One streamed event, read as ev.type / ev.data / ev.extra or unpacked as a tuple.
+
+    A NamedTuple has empty __slots__, so events carry no per-instance dict.
+
+    extra is None or a dict of event-specific fields (tool_interaction data,
+    hypothesis progress, extraction stats).
+    """
+    type: str
+    data: Any
+    extra: Any = None
+
+
+# Text delta event class, bound once for the exact-type check in run_stream
+_DeltaCls = ResponseTextDeltaEvent
+
+
+def _parse_tool_arguments(raw_arguments):
+    """Parse a tool call's JSON argument string, keeping it raw if it is not valid JSON."""
+    if not raw_arguments:
+        return None
+    try:
+        return orjson.loads(raw_arguments)
+    except orjson.JSONDecodeError:
+        return {"raw_arguments": raw_arguments}
+
+
+def _format_tool_info(tool_call_data):
+    """Build the console display string for a tool call (keeps existing UX)."""
+    tool_info = f"Calling tool: {tool_call_data['tool_name']}"
+    input_args = tool_call_data["input_args"]
+    if input_args and isinstance(input_args, dict):
+        if tool_call_data['tool_name'] == "literature_search" and 'query' in input_args:
+            tool_info += f" - Searching for: '{input_args['query']}'"
+        else:
+            # Show key parameters (truncate for display only)
+            params = []
+            for key, value in itertools.islice(input_args.items(), 2):
+                # Convert once and truncate any value type, so large dicts/lists stay short too
+                display_value = value if type(value) is str else repr(value)
+                if len(display_value) > 50:
+                    display_value = display_value[:47] + "..."
+                params.append(f"{key}: {display_value}")
+            if params:
+                tool_info += f" - Parameters: {', '.join(params)}"
+    return tool_info
+
+
+class _LazyStr:
+    """String placeholder that runs its formatter on first str() and caches the result."""
     
-    def __init__(self, name="Assistant", instructions="You are a helpful assistant.", model=None, tools=None):
-        """
-        Initialize the OpenAI Agent.
+    __slots__ = ("_func", "_arg", "_value")
+    
+    def __init__(self, func, arg):
+        self._func = func
+        self._arg = arg
+        self._value = None
+    
+    def __str__(self):
+        if self._value is None:
+            self._value = self._func(self._arg)
+            self._func = self._arg = None
+        return self._value
+    
+    def __repr__(self):
+        return repr(str(self))
+
+
+def _handle_tool_call(item):
+    """Turn a tool_call_item into a tool_call event."""
+    logger.debug("Tool call detected - %s", item.raw_item.name)
+    # Extract complete tool call information
+    tool_call_data = {
+        "tool_name": item.raw_item.name,
+        "timestamp": datetime.now().isoformat(),
+        # Full arguments (not truncated)
+        "input_args": _parse_tool_arguments(getattr(item.raw_item, 'arguments', None))
+    }
+    
+    # Display string is built only when printed; extra holds the complete tool data
+    return StreamEvent(TYPE_TOOL_CALL, _LazyStr(_format_tool_info, tool_call_data), tool_call_data)
+
+
+def _handle_tool_output(item):
+    """Turn a tool_call_output_item into a tool_output event."""
+    logger.debug("Tool output detected")
+    output = item.output
+    # Extract complete tool output information
+    tool_output_data = {
+        "timestamp": datetime.now().isoformat(),
+        "output": output,
+        "output_length": len(str(output)) if output else 0
+    }
+    return StreamEvent(TYPE_TOOL_OUTPUT, output, tool_output_data)
+
+
+_message_text = ItemHelpers.text_message_output
+
+
+def _handle_message(item):
+    """Turn a message_output_item into a message event, or None when it has no text."""
+    text = _message_text(item)
+    return StreamEvent(TYPE_MESSAGE, text) if text else None
+
+
+# run_item_stream_event item type -> handler returning the event to yield (or None)
+_ITEM_HANDLERS = {
+    "tool_call_item": _handle_tool_call,
+    "tool_call_output_item": _handle_tool_output,
+    "message_output_item": _handle_message,
+}
+
+
+class _StreamState:
+    """Per-run bookkeeping shared by the run_stream_with_extraction event handlers."""
+    
+    __slots__ = ("expected_count", "parser", "extracted_count",
+                 "pending_tool_calls", "completed_interactions")
+    
+    def __init__(self, expected_count):
+        self.expected_count = expected_count
+        self.parser = HypothesisStreamParser()  # Persistent scan state across deltas
+        self.extracted_count = 0
+        self.pending_tool_calls = deque()  # (call_data, monotonic start ns) in call order
+        self.completed_interactions = []  # Store completed tool interactions
+
+
+def _on_tool_call(data, call_data, state):
+    """Queue a tool call until its output arrives (sequential pairing)."""
+    if call_data is not None:
+        logger.debug("Storing tool call #%d - %s", len(state.pending_tool_calls) + 1, call_data['tool_name'])
+        # Monotonic start for duration math, kept out of the yielded tool data
+        state.pending_tool_calls.append((call_data, time.monotonic_ns()))
+    return ()
+
+
+def _on_tool_output(data, output_data, state):
+    """Pair a tool output with the oldest pending call and record the interaction."""
+    if output_data is None:
+        return ()
+    pending_tool_calls = state.pending_tool_calls
+    logger.debug("Processing tool output, %d pending calls", len(pending_tool_calls))
+    
+    # Match with oldest pending tool call (FIFO order)
+    if pending_tool_calls:
+        call_data, t0_ns = pending_tool_calls.popleft()  # Remove first (oldest) call in O(1)
+        interaction = {
+            "tool_name": call_data["tool_name"],
+            "timestamp_start": call_data["timestamp"],
+            "timestamp_end": output_data["timestamp"],
+            "input_args": call_data["input_args"],
+            "output": output_data["output"],
+            "output_length": output_data["output_length"]
+        }
         
-        Args:
-            name: Name of the agent
-            instructions: System instructions for the agent
-        """
+        # Duration from the monotonic clock (ISO timestamps are kept for logs only)
+        interaction["duration_ms"] = (time.monotonic_ns() - t0_ns) // 1_000_000
+        
+        state.completed_interactions.append(interaction)
+        logger.debug("Created interaction #%d - %s, duration: %sms",
+                     len(state.completed_interactions), interaction['tool_name'], interaction['duration_ms'])
+    return ()
+
+
+def _on_text(delta, extra, state):
+    """Feed a text delta to the parser and build events for completed hypotheses."""
+    # Each hypothesis is emitted as soon as its closing brace streams in
+    hypotheses = state.parser.feed(delta)
+    if not hypotheses:
+        return ()
+    
+    # Emit events for newly found hypotheses
+    expected_count = state.expected_count
+    found_events = []
+    for hypothesis in hypotheses:
+        state.extracted_count += 1
+        extracted_count = state.extracted_count
+        
+        # Build progress indicator
+        progress = f"{extracted_count}/{expected_count}" if expected_count else str(extracted_count)
+        
+        found_events.append(StreamEvent(TYPE_HYPOTHESIS_FOUND, hypothesis, {
+            "id": extracted_count,
+            "progress": progress,
+            "summary": (
+                f"Hypothesis {extracted_count}: "
+                f"{hypothesis.get('claim', '')[:80]}..."
+            ),
+        }))
+    return found_events
+
+
+# Event type -> handler returning any follow-up events to yield after the original one
+HANDLERS = {
+    TYPE_TOOL_CALL: _on_tool_call,
+    TYPE_TOOL_OUTPUT: _on_tool_output,
+    TYPE_TEXT: _on_text,
+}
+TOOL_HANDLERS = {key: HANDLERS[key] for key in (TYPE_TOOL_CALL, TYPE_TOOL_OUTPUT)}
+
+
+# Default maximum age of buffered text when run_stream coalescing is enabled
+COALESCE_DEADLINE_S = 0.03
+
+
+# Agents built so far, keyed by configuration (oldest entry evicted past the limit)
+AGENT_CACHE_SIZE = 32
+_agent_cache = {}
+
+
+def _get_agent(name, instructions, model=None, tools=None):
+    """
+    Return the Agent for this configuration, building it only on first use.
+    
+    Models and tools are keyed by identity (FunctionTool is unhashable), so callers
+    must pass the same objects to get a hit; a cached Agent keeps them alive, so
+    their ids cannot be reused while the entry exists. Instruction callables such as
+    hypothesis_generator_instructions are module-level functions and stable across calls.
+    """
+    key = (
+        name,
+        instructions,
+        model if isinstance(model, str) else id(model),
+        None if tools is None else tuple(map(id, tools)),
+    )
+    agent = _agent_cache.get(key)
+    if agent is None:
         agent_kwargs = {
             "name": name,
             "instructions": instructions,
@@ -38,8 +272,52 @@ class OpenAIAgentWrapper:
             agent_kwargs["model"] = model
         if tools is not None:
             agent_kwargs["tools"] = tools
-            
-        self.agent = Agent(**agent_kwargs)
+        agent = Agent(**agent_kwargs)
+        
+        if len(_agent_cache) >= AGENT_CACHE_SIZE:
+            del _agent_cache[next(iter(_agent_cache))]
+        _agent_cache[key] = agent
+    return agent
+
+
+@functools.lru_cache(maxsize=128)
+def _prompt_cache_run_config(context_repr):
+    """
+    Return a RunConfig that sends a stable prompt_cache_key for a context's repr.
+    
+    The generator instructions are rendered from the (frozen) context, so equal contexts
+    share an identical system prompt; keying on it routes repeat runs, across requests
+    and worker processes, to the provider cache that already holds that prefix. The
+    repr string is the cache key, so field values never need to be hashable.
+    """
+    digest = hashlib.sha256(context_repr.encode()).hexdigest()[:32]
+    return RunConfig(model_settings=ModelSettings(extra_args={"prompt_cache_key": f"hypgen-{digest}"}))
+
+
+class OpenAIAgentWrapper:
+    """Wrapper class for OpenAI Agent operations."""
+    
+    def __init__(self, name="Assistant", instructions="You are a helpful assistant.", model=None, tools=None,
+                 prompt_cache=False):
+        """
+        Initialize the OpenAI Agent.
+        
+        Args:
+            name: Name of the agent
+            instructions: System instructions for the agent
+            prompt_cache: Send a prompt_cache_key derived from the run context (OpenAI only)
+        """
+        if isinstance(instructions, str):
+            # Equal instruction strings become one object, so agent cache keys compare by identity
+            instructions = sys.intern(instructions)
+        self.agent = _get_agent(name, instructions, model, tools)
+        self.prompt_cache = prompt_cache
+    
+    def _run_config(self, context):
+        """RunConfig for a run with this context, or None to use the SDK defaults."""
+        if self.prompt_cache and context is not None:
+            return _prompt_cache_run_config(repr(context))
+        return None
     
     async def run(self, prompt: str, context=None):
         """
@@ -51,88 +329,111 @@ class OpenAIAgentWrapper:
         Returns:
             The agent's response
         """
-        result = await Runner.run(self.agent, prompt, context=context)
+        result = await Runner.run(self.agent, prompt, context=context,
+                                  run_config=self._run_config(context))
         return result.final_output
     
-    async def run_stream(self, prompt: str, context=None):
+    async def run_stream(self, prompt: str, context=None, coalesce_chars: int = 0,
+                         coalesce_deadline_s: float = COALESCE_DEADLINE_S):
         """
         Run the agent with streaming output.
         
         Args:
             prompt: The user prompt to process
             context: Optional context for the agent
+            coalesce_chars: Opt-in text coalescing. When > 0, deltas are buffered and
+                yielded together once this many characters or a newline have arrived,
+                before any other event, and at the end of the stream
+            coalesce_deadline_s: Maximum age of buffered text when coalescing; a timer
+                flushes it even while the model output is paused
             
         Yields:
-            Stream events from the agent
+            StreamEvent (type, data, extra) tuples; extra carries the complete
+            tool_interaction data for tool events and is None otherwise
         """
-        from openai.types.responses import ResponseTextDeltaEvent
-        from agents import ItemHelpers
+        result = Runner.run_streamed(self.agent, prompt, context=context,
+                                     run_config=self._run_config(context))
         
-        result = Runner.run_streamed(self.agent, prompt, context=context)
+        # Module globals and bound methods hoisted to locals for the per-token loop
+        stream_events = result.stream_events()
+        get_item_handler = _ITEM_HANDLERS.get
+        delta_cls = _DeltaCls
+        text_type = TYPE_TEXT
+        event_cls = StreamEvent
         
-        async for event in result.stream_events():
-            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
-                # Stream text deltas as they come
-                yield {"type": "text", "data": event.data.delta}
-            elif event.type == "run_item_stream_event":
-                if event.item.type == "tool_call_item":
-                    print(f"🔧 DEBUG: Tool call detected - {event.item.raw_item.name}")
-                    # Extract complete tool call information
-                    tool_call_data = {
-                        "tool_name": event.item.raw_item.name,
-                        "timestamp": datetime.now().isoformat(),
-                        "input_args": None
-                    }
-                    
-                    # Parse full arguments (not truncated)
-                    if hasattr(event.item.raw_item, 'arguments') and event.item.raw_item.arguments:
-                        try:
-                            tool_call_data["input_args"] = json.loads(event.item.raw_item.arguments)
-                        except json.JSONDecodeError:
-                            tool_call_data["input_args"] = {"raw_arguments": event.item.raw_item.arguments}
-                    
-                    # Create display string for console (keep existing UX)
-                    tool_info = f"Calling tool: {tool_call_data['tool_name']}"
-                    if tool_call_data["input_args"] and isinstance(tool_call_data["input_args"], dict):
-                        if tool_call_data['tool_name'] == "literature_search" and 'query' in tool_call_data["input_args"]:
-                            tool_info += f" - Searching for: '{tool_call_data['input_args']['query']}'"
-                        else:
-                            # Show key parameters (truncate for display only)
-                            params = []
-                            for key, value in list(tool_call_data["input_args"].items())[:2]:
-                                if isinstance(value, str) and len(value) > 50:
-                                    display_value = value[:47] + "..."
-                                else:
-                                    display_value = value
-                                params.append(f"{key}: {display_value}")
-                            if params:
-                                tool_info += f" - Parameters: {', '.join(params)}"
-                    
-                    yield {
-                        "type": "tool_call", 
-                        "data": tool_info,
-                        "tool_interaction": tool_call_data  # NEW: Complete tool data
-                    }
-                elif event.item.type == "tool_call_output_item":
-                    print(f"🔧 DEBUG: Tool output detected")
-                    # Extract complete tool output information
-                    tool_output_data = {
-                        "timestamp": datetime.now().isoformat(),
-                        "output": event.item.output,
-                        "output_length": len(str(event.item.output)) if event.item.output else 0
-                    }
+        # Coalescing buffer (unused unless coalesce_chars > 0)
+        clock = asyncio.get_running_loop().time
+        text_buffer = []
+        buffered_chars = 0
+        buffer_started = 0.0
+        
+        next_event = None
+        try:
+            while True:
+                if text_buffer:
+                    # Wait for the next event only until the buffered text is due
+                    if next_event is None:
+                        next_event = asyncio.ensure_future(anext(stream_events))
+                    remaining = coalesce_deadline_s - (clock() - buffer_started)
+                    if remaining <= 0 or not (await asyncio.wait((next_event,), timeout=remaining))[0]:
+                        yield event_cls(text_type, "".join(text_buffer))
+                        text_buffer.clear()
+                        buffered_chars = 0
+                        continue
+                try:
+                    if next_event is not None:
+                        event = await next_event
+                    else:
+                        event = await anext(stream_events)
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_event = None
+                
+                event_type = event.type
+                if event_type == "raw_response_event":
+                    data = event.data
+                    # Exact type check first (the SDK emits the concrete class); isinstance only on a miss
+                    if type(data) is not delta_cls and not isinstance(data, delta_cls):
+                        continue
+                    if not coalesce_chars:
+                        # Stream text deltas as they come
+                        yield event_cls(text_type, data.delta)
+                        continue
+                    delta = data.delta
+                    if not text_buffer:
+                        buffer_started = clock()
+                    text_buffer.append(delta)
+                    buffered_chars += len(delta)
+                    if buffered_chars >= coalesce_chars or "\n" in delta:
+                        yield event_cls(text_type, "".join(text_buffer))
+                        text_buffer.clear()
+                        buffered_chars = 0
+                elif event_type == "run_item_stream_event":
+                    # Flush coalesced text first so events stay in order
+                    if text_buffer:
+                        yield event_cls(text_type, "".join(text_buffer))
+                        text_buffer.clear()
+                        buffered_chars = 0
                     
-                    yield {
-                        "type": "tool_output", 
-                        "data": event.item.output,
-                        "tool_interaction": tool_output_data  # NEW: Complete output data
-                    }
-                elif event.item.type == "message_output_item":
-                    text = ItemHelpers.text_message_output(event.item)
-                    if text:
-                        yield {"type": "message", "data": text}
+                    item = event.item
+                    handler = get_item_handler(item.type)
+                    if handler:
+                        out = handler(item)
+                        if out:
+                            yield out
+        finally:
+            # Consumer stopped early: cancel the pending read before closing the SDK stream
+            if next_event is not None:
+                next_event.cancel()
+                await asyncio.gather(next_event, return_exceptions=True)
+            await stream_events.aclose()
+        
+        if text_buffer:
+            yield event_cls(text_type, "".join(text_buffer))
 
-    async def run_stream_with_extraction(self, prompt: str, context=None):
+    async def run_stream_with_extraction(self, prompt: str, context=None, enable_extraction: bool = True,
+                                         coalesce_chars: int = 0):
         """
         Enhanced streaming with real-time hypothesis extraction and tool interaction logging.
         
@@ -142,235 +443,410 @@ class OpenAIAgentWrapper:
         Args:
             prompt: The user prompt to process
             context: Optional context (contains expected hypothesis count)
+            enable_extraction: When False, behave exactly like run_stream() (no
+                parsing or tool pairing); callers that only need raw text skip all of it
+            coalesce_chars: Passed to run_stream() to opt into text coalescing
             
         Yields:
             - All original stream events from run_stream()
             - "hypothesis_found" events when complete JSON blocks detected
-            - "extraction_complete" summary event at the end
-            - Enhanced events include tool_interaction data for logging
+              (data is the hypothesis; extra has id, progress and summary)
+            - "extraction_complete" summary event at the end (data is the
+              message; extra has total_hypotheses, expected and tool_interactions)
         """
-        from backend_utils import extract_hypotheses
+        if not enable_extraction:
+            async for event in self.run_stream(prompt, context, coalesce_chars):
+                yield event
+            return
         
         # Extract expected count from context for progress tracking
         expected_count = getattr(context, 'number_of_hypothesis', None) if context else None
-        
-        # Initialize tracking variables
-        text_buffer = ""
-        extracted_count = 0
-        pending_tool_calls = []  # Store tool calls in order
-        completed_interactions = []  # Store completed tool interactions
+        state = _StreamState(expected_count)
+        # Nothing to extract when no hypotheses were requested; tool pairing still runs
+        handlers = HANDLERS if expected_count != 0 else TOOL_HANDLERS
 
         # Delegate to existing run_stream and enhance with extraction
-        async for event in self.run_stream(prompt, context):
-            # Process tool interactions for logging (sequential pairing)
-            if event.get("type") == "tool_call" and "tool_interaction" in event:
-                call_data = event["tool_interaction"]
-                print(f"🔧 DEBUG: Storing tool call #{len(pending_tool_calls) + 1} - {call_data['tool_name']}")
-                pending_tool_calls.append(call_data)
-                
-            elif event.get("type") == "tool_output" and "tool_interaction" in event:
-                output_data = event["tool_interaction"]
-                print(f"🔧 DEBUG: Processing tool output, {len(pending_tool_calls)} pending calls")
-                
-                # Match with oldest pending tool call (FIFO order)
-                if pending_tool_calls:
-                    call_data = pending_tool_calls.pop(0)  # Remove first (oldest) call
-                    interaction = {
-                        "tool_name": call_data["tool_name"],
-                        "timestamp_start": call_data["timestamp"],
-                        "timestamp_end": output_data["timestamp"],
-                        "input_args": call_data["input_args"],
-                        "output": output_data["output"],
-                        "output_length": output_data["output_length"]
-                    }
-                    
-                    # Calculate duration if both timestamps are valid
-                    try:
-                        start_time = datetime.fromisoformat(call_data["timestamp"])
-                        end_time = datetime.fromisoformat(output_data["timestamp"])
-                        interaction["duration_ms"] = int((end_time - start_time).total_seconds() * 1000)
-                    except:
-                        interaction["duration_ms"] = None
-                    
-                    completed_interactions.append(interaction)
-                    print(f"🔧 DEBUG: Created interaction #{len(completed_interactions)} - {interaction['tool_name']}, duration: {interaction.get('duration_ms')}ms")
+        async for event in self.run_stream(prompt, context, coalesce_chars):
+            handler = handlers.get(event.type)
+            extra_events = handler(event.data, event.extra, state) if handler else ()
             
             # Always yield original events first (preserves existing behavior)
             yield event
-
-            # Only process text events for hypothesis extraction
-            if event.get("type") != "text":
-                continue
-
-            # Accumulate text in buffer
-            text_buffer += event["data"]
-            
-            # Run extraction on the growing buffer
-            hypotheses = extract_hypotheses(text_buffer)
-
-            # Skip if no new hypotheses found
-            if len(hypotheses) <= extracted_count:
-                continue
-
-            # Emit events for newly found hypotheses
-            for index in range(extracted_count, len(hypotheses)):
-                hypothesis = hypotheses[index]
-                extracted_count += 1
-                
-                # Build progress indicator
-                progress = f"{extracted_count}/{expected_count}" if expected_count else str(extracted_count)
-                
-                yield {
-                    "type": "hypothesis_found",
-                    "data": hypothesis,
-                    "id": extracted_count,
-                    "progress": progress,
-                    "summary": (
-                        f"Hypothesis {extracted_count}: "
-                        f"{hypothesis.get('claim', '')[:80]}..."
-                    ),
-                }
+            for extra_event in extra_events:
+                yield extra_event
 
         # Emit final summary with tool interactions
-        print(f"🔧 DEBUG: Final - {len(completed_interactions)} tool interactions to include in extraction_complete")
+        extracted_count = state.extracted_count
+        completed_interactions = state.completed_interactions
+        logger.debug("Final - %d tool interactions to include in extraction_complete", len(completed_interactions))
         if extracted_count > 0 or completed_interactions:
-            yield {
-                "type": "extraction_complete",
+            message = (
+                f"Successfully extracted {extracted_count} hypothesis"
+                f"{'es' if extracted_count != 1 else ''}"
+                + (f" (expected {expected_count})" if expected_count else "")
+                + f" | Tool calls: {len(completed_interactions)}"
+            )
+            yield StreamEvent(TYPE_EXTRACTION_COMPLETE, message, {
                 "total_hypotheses": extracted_count,
                 "expected": expected_count,
-                "tool_interactions": completed_interactions,  # NEW: Complete tool data
-                "message": (
-                    f"Successfully extracted {extracted_count} hypothesis"
-                    f"{'es' if extracted_count != 1 else ''}"
-                    + (f" (expected {expected_count})" if expected_count else "")
-                    + f" | Tool calls: {len(completed_interactions)}"
-                ),
-            }
-
-
-def get_user_input():
-    """Get user input for hypothesis generation parameters."""
+                "tool_interactions": completed_interactions,  # Complete tool data
+            })
+
+
+# Maximum delay before buffered console output is flushed
+RENDER_FLUSH_INTERVAL_S = 0.016
+
+
+async def _render_output(output_queue: asyncio.Queue):
+    """
+    Write queued console output in batches.
+    
+    Output is flushed when a line completes or at most RENDER_FLUSH_INTERVAL_S after
+    the last flush. A None item flushes whatever is left and stops the renderer.
+    """
+    # Bound once; stdout isn't swapped while the renderer runs
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+    get_nowait = output_queue.get_nowait
+    
+    pending = []
+    last_flush = time.monotonic()
+    while True:
+        try:
+            # Only wait with a deadline while there is something left to flush
+            if pending:
+                item = await asyncio.wait_for(output_queue.get(), RENDER_FLUSH_INTERVAL_S)
+            else:
+                item = await output_queue.get()
+        except asyncio.TimeoutError:
+            item = ""
+        
+        # Take everything already queued without another await
+        newline = False
+        while item is not None:
+            if item:
+                pending.append(item)
+                newline = newline or "\n" in item
+            try:
+                item = get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        
+        if item is None:
+            write("".join(pending))
+            flush()
+            return
+        
+        now = time.monotonic()
+        if pending and (newline or now - last_flush >= RENDER_FLUSH_INTERVAL_S):
+            write("".join(pending))
+            flush()
+            pending.clear()
+            last_flush = now
+
+
+# Requests for at most this many hypotheses use the *_FAST_MODEL_NAME model if set
+FAST_MODEL_MAX_HYPOTHESES = 2
+
+
+def _configured_model_names(provider):
+    """Return the (model_name, fast_model_name) pair configured for a provider."""
+    # Get model name from environment variables
+    settings = get_settings()
+    if provider == "openai":
+        return settings.openai_model, settings.openai_fast_model
+    return settings.openrouter_model, settings.openrouter_fast_model
+
+
+def _select_model_name(provider, num_hypotheses):
+    """Pick the model name for a request, routing small requests to the fast model if configured."""
+    model_name, fast_model_name = _configured_model_names(provider)
+    
+    # Small requests (the interactive/demo path) go to the faster model when one is configured
+    if fast_model_name and num_hypotheses <= FAST_MODEL_MAX_HYPOTHESES:
+        logger.info("Routing %d hypothesis request to fast model %s", num_hypotheses, fast_model_name)
+        model_name = fast_model_name
+    return model_name
+
+
+# Built once so every generator agent shares the same tool objects (and agent cache entry)
+GENERATOR_TOOLS = [cached_literature_search.as_tool(
+    tool_name="literature_search",
+    tool_description="Search for academic and scholarly information"
+), literature_search_batch]
+
+
+def build_generator_agent(model, name="Hypotheses Generator Agent 1"):
+    """
+    Create the hypothesis generator agent with the literature search tools.
+    
+    Shared by the CLI, batch mode and the API server so the agent is defined in one place.
+    OpenAI models (passed as a name string) get a per-context prompt_cache_key; OpenRouter
+    models go through Chat Completions, where the SDK cannot attach Anthropic cache_control
+    markers to the system message, so they rely on the provider's automatic caching.
+    """
+    return OpenAIAgentWrapper(name=name,
+                              instructions=hypothesis_generator_instructions,
+                              tools=GENERATOR_TOOLS,
+                              model=model,
+                              prompt_cache=isinstance(model, str))
+
+
+async def get_user_input():
+    """Get user input for hypothesis generation parameters (input() runs off the event loop)."""
     print("=== Hypothesis Generator Setup ===")
-    domain = input("Research domain (e.g., 'AI for Drug Discovery'): ")
-    num_hypotheses = int(input("Number of hypotheses to generate: "))
-    research_idea = input("Describe your research idea: ")
+    domain = await asyncio.to_thread(input, "Research domain (e.g., 'AI for Drug Discovery'): ")
+    num_hypotheses = int(await asyncio.to_thread(input, "Number of hypotheses to generate: "))
+    research_idea = await asyncio.to_thread(input, "Describe your research idea: ")
     return domain, num_hypotheses, research_idea
 
 
 async def main():
     """Main function to demonstrate OpenAI agent usage."""
+    settings = get_settings()
+    
+    # Configure model provider
+    provider = settings.provider
+    
+    # Build the default model and agent while the user is typing (silently, so the
+    # banner doesn't interleave with the input prompts)
+    default_model_name, _ = _configured_model_names(provider)
+    warmup = asyncio.create_task(asyncio.to_thread(
+        lambda: build_generator_agent(create_model(provider, default_model_name, announce=False))
+    ))
     
     # Get user input
-    domain, num_hypotheses, research_idea = get_user_input()
+    try:
+        domain, num_hypotheses, research_idea = await get_user_input()
+    except BaseException:
+        # Bad input, EOF or Ctrl-C: let the warm-up thread finish and retrieve its result
+        await asyncio.gather(warmup, return_exceptions=True)
+        raise
     
-    # Configure model provider
-    provider = os.getenv("MODEL_PROVIDER", "openai")
     print(f"\nModel provider: {provider}")
 
     print("\n=== Streaming Hypothesis Generation ===")
     
-    # Get model name from environment variables
-    if provider == "openai":
-        model_name = os.getenv("OPENAI_MODEL_NAME")
-    else:
-        model_name = os.getenv("OPENROUTER_MODEL_NAME")
-    
-    hypothesis_model = create_model(provider, model_name)
-    
-    hypotheses_generator_agent = OpenAIAgentWrapper(name="Hypotheses Generator Agent 1",
-                                                    instructions=hypothesis_generator_instructions,
-                                                    tools=[literature_agent.as_tool(
-                                                        tool_name="literature_search",
-                                                        tool_description="Search for academic and scholarly information"
-                                                    )],
-                                                    model=hypothesis_model)
+    model_name = _select_model_name(provider, num_hypotheses)
+    hypotheses_generator_agent = await warmup
+    # Cached model, so this only prints the banner for the model actually used
+    model = create_model(provider, model_name)
+    if model_name != default_model_name:
+        # Routed to the fast model; the warmed-up default agent isn't used
+        print(f"Routing {num_hypotheses} hypothesis request to fast model")
+        hypotheses_generator_agent = build_generator_agent(model)
     context = ResearchContext(
         problem_space_title=domain,
         number_of_hypothesis=num_hypotheses
     )
     
     # Initialize session tracking variables
-    raw_output = ""
+    # Raw output is spooled to a temp file rather than held in memory; save_session reads it back
+    raw_output_file = tempfile.NamedTemporaryFile("w+", encoding="utf-8", suffix=".txt", delete=False)
+    raw_output_length = 0
     extracted_hypotheses = []
     extraction_stats = {}
     tool_interactions = []
     
-    # Use streaming instead of waiting for complete response
-    print(f"Generating {num_hypotheses} hypotheses for {domain}...\n")
-    async for event in hypotheses_generator_agent.run_stream_with_extraction(prompt=f"Please generate hypotheses for the following research idea : {research_idea}", context=context):
-        if event["type"] == "text":
-            # Print text as it streams in, character by character
-            print(event["data"], end="", flush=True)
-            # Collect raw output
-            raw_output += event["data"]
-        elif event["type"] == "tool_call":
-            # Show when a tool is being called
-            print(f"\n>>> {event['data']}\n")
-            # Track tool calls in raw output
-            raw_output += f"\n>>> {event['data']}\n"
-        elif event["type"] == "tool_output":
-            # Show tool results (truncated for readability)
-            output_preview = str(event['data'])[:100] + "..." if len(str(event['data'])) > 100 else str(event['data'])
-            print(f">>> Tool result: {output_preview}\n")
-            # Track tool results in raw output
-            raw_output += f">>> Tool result: {output_preview}\n"
-        elif event["type"] == "hypothesis_found":
-            # Show real-time hypothesis detection
-            print(f"\n{'='*60}")
-            print(f"[{event['progress']} HYPOTHESIS EXTRACTED]")
-            print(f"Summary: {event['summary']}")
-            print(f"\nFull hypothesis data:")
-            hypothesis = event['data']
-            for key, value in hypothesis.items():
-                if key.startswith('_'):  # Skip metadata fields for cleaner display
-                    continue
-                print(f"  • {key}: {value}")
-            print(f"{'='*60}\n")
-            # Collect extracted hypothesis
-            extracted_hypotheses.append(hypothesis)
-        elif event["type"] == "extraction_complete":
-            # Final summary of extraction
+    # Console output is rendered by a background task so terminal I/O never stalls the stream
+    output_queue = asyncio.Queue()
+    renderer = asyncio.create_task(_render_output(output_queue))
+    write = output_queue.put_nowait
+    
+    # The temp file and renderer are cleaned up even if the stream fails or is interrupted
+    try:
+        # Use streaming instead of waiting for complete response
+        print(f"Generating {num_hypotheses} hypotheses for {domain}...\n")
+        async for event_type, data, extra in hypotheses_generator_agent.run_stream_with_extraction(prompt=f"Please generate hypotheses for the following research idea : {research_idea}", context=context, enable_extraction=True):
+            if event_type == TYPE_TEXT:
+                # Print text as it streams in
+                write(data)
+                # Collect raw output
+                raw_output_length += raw_output_file.write(data)
+            elif event_type == TYPE_TOOL_CALL:
+                # Show when a tool is being called
+                write(f"\n>>> {data}\n\n")
+                # Track tool calls in raw output
+                raw_output_length += raw_output_file.write(f"\n>>> {data}\n")
+            elif event_type == TYPE_TOOL_OUTPUT:
+                # Show tool results (truncated for readability)
+                output_text = data if isinstance(data, str) else str(data)
+                output_preview = output_text if len(output_text) <= 100 else output_text[:100] + "..."
+                write(f">>> Tool result: {output_preview}\n\n")
+                # Track tool results in raw output
+                raw_output_length += raw_output_file.write(f">>> Tool result: {output_preview}\n")
+            elif event_type == TYPE_HYPOTHESIS_FOUND:
+                # Show real-time hypothesis detection
+                write(f"\n{'='*60}\n")
+                write(f"[{extra['progress']} HYPOTHESIS EXTRACTED]\n")
+                write(f"Summary: {extra['summary']}\n")
+                write(f"\nFull hypothesis data:\n")
+                hypothesis = data
+                for key, value in hypothesis.items():
+                    if key.startswith('_'):  # Skip metadata fields for cleaner display
+                        continue
+                    write(f"  • {key}: {value}\n")
+                write(f"{'='*60}\n\n")
+                # Collect extracted hypothesis
+                extracted_hypotheses.append(hypothesis)
+            elif event_type == TYPE_EXTRACTION_COMPLETE:
+                # Final summary of extraction
+                write(f"\n{'='*60}\n")
+                write("=== EXTRACTION COMPLETE ===\n")
+                write(f"{data}\n")
+                write(f"Total extracted: {extra.get('total_hypotheses', 0)}\n")
+                write(f"Expected: {extra.get('expected', 'N/A')}\n")
+                write(f"{'='*60}\n\n")
+                # Collect extraction stats and tool interactions
+                extraction_stats = {
+                    "total_extracted": extra.get('total_hypotheses', 0),
+                    "expected": extra.get('expected', None),
+                    "extraction_time": datetime.now().isoformat(),
+                    "message": data
+                }
+                # Collect tool interactions for enhanced logging
+                tool_interactions = extra.get('tool_interactions', [])
+        
+        # Drain the renderer before printing the session summary
+        write(None)
+        await renderer
+        raw_output_file.close()
+        
+        # Save session after streaming completes (SESSION_FORMAT=msgpack for binary archives)
+        writer = save_session_msgpack if settings.session_format == "msgpack" else save_session
+        try:
+            session_file = writer(
+                domain=domain,
+                num_hypotheses=num_hypotheses, 
+                research_idea=research_idea,
+                provider=provider,
+                model_name=model_name or "unknown",
+                raw_output=None,
+                raw_output_path=raw_output_file.name,
+                extracted_hypotheses=extracted_hypotheses,
+                extraction_stats=extraction_stats,
+                tool_interactions=tool_interactions  # NEW: Pass tool interaction data
+            )
             print(f"\n{'='*60}")
-            print("=== EXTRACTION COMPLETE ===")
-            print(event['message'])
-            print(f"Total extracted: {event.get('total_hypotheses', 0)}")
-            print(f"Expected: {event.get('expected', 'N/A')}")
+            print("=== SESSION SAVED ===")
+            print(f"Session saved to: {session_file}")
+            print(f"Hypotheses extracted: {len(extracted_hypotheses)}")
+            print(f"Tool interactions: {len(tool_interactions)}")
+            print(f"Raw output length: {raw_output_length} characters")
             print(f"{'='*60}\n")
-            # Collect extraction stats and tool interactions
-            extraction_stats = {
-                "total_extracted": event.get('total_hypotheses', 0),
-                "expected": event.get('expected', None),
-                "extraction_time": datetime.now().isoformat(),
-                "message": event.get('message', '')
-            }
-            # Collect tool interactions for enhanced logging
-            tool_interactions = event.get('tool_interactions', [])
-    
-    # Save session after streaming completes
-    try:
-        session_file = save_session(
-            domain=domain,
-            num_hypotheses=num_hypotheses, 
-            research_idea=research_idea,
-            provider=provider,
-            model_name=model_name or "unknown",
-            raw_output=raw_output,
-            extracted_hypotheses=extracted_hypotheses,
-            extraction_stats=extraction_stats,
-            tool_interactions=tool_interactions  # NEW: Pass tool interaction data
-        )
-        print(f"\n{'='*60}")
-        print("=== SESSION SAVED ===")
-        print(f"Session saved to: {session_file}")
-        print(f"Hypotheses extracted: {len(extracted_hypotheses)}")
-        print(f"Tool interactions: {len(tool_interactions)}")
-        print(f"Raw output length: {len(raw_output)} characters")
-        print(f"{'='*60}\n")
-    except Exception as e:
-        print(f"\n⚠️  Warning: Failed to save session: {e}")
-        print("Session data was generated but not persisted.")
+        except Exception as e:
+            print(f"\n⚠️  Warning: Failed to save session: {e}")
+            print("Session data was generated but not persisted.")
+    finally:
+        if not renderer.done():
+            write(None)
+            await renderer
+        raw_output_file.close()
+        os.unlink(raw_output_file.name)
+
+
+async def run_batch(jobs, concurrency=5):
+    """
+    Generate hypotheses for many independent research ideas concurrently.
+    
+    Each job runs the same extraction stream as main() without console streaming
+    and is saved as its own session. At most `concurrency` runs are in flight,
+    so throughput scales with the provider's concurrent request limit.
+    
+    Args:
+        jobs: List of (domain, num_hypotheses, research_idea) tuples
+        concurrency: Maximum number of generations running at once
+        
+    Returns:
+        List of saved session file paths (None for jobs that failed), in job order
+    """
+    settings = get_settings()
+    provider = settings.provider
+    writer = save_session_msgpack if settings.session_format == "msgpack" else save_session
+    semaphore = asyncio.Semaphore(concurrency)
     
+    async def run_job(index, domain, num_hypotheses, research_idea):
+        async with semaphore:
+            model_name = _select_model_name(provider, num_hypotheses)
+            agent = build_generator_agent(create_model(provider, model_name, announce=False))
+            context = ResearchContext(
+                problem_space_title=domain,
+                number_of_hypothesis=num_hypotheses
+            )
+            
+            raw_output_parts = []
+            extracted_hypotheses = []
+            extraction_stats = {}
+            tool_interactions = []
+            async for event_type, data, extra in agent.run_stream_with_extraction(prompt=f"Please generate hypotheses for the following research idea : {research_idea}", context=context):
+                if event_type == TYPE_TEXT:
+                    raw_output_parts.append(data)
+                elif event_type == TYPE_TOOL_CALL:
+                    raw_output_parts.append(f"\n>>> {data}\n")
+                elif event_type == TYPE_HYPOTHESIS_FOUND:
+                    extracted_hypotheses.append(data)
+                elif event_type == TYPE_EXTRACTION_COMPLETE:
+                    extraction_stats = {
+                        "total_extracted": extra.get('total_hypotheses', 0),
+                        "expected": extra.get('expected', None),
+                        "extraction_time": datetime.now().isoformat(),
+                        "message": data
+                    }
+                    tool_interactions = extra.get('tool_interactions', [])
+            
+            # Serialize and write off the event loop so other jobs keep streaming
+            session_file = await asyncio.to_thread(
+                writer,
+                domain=domain,
+                num_hypotheses=num_hypotheses,
+                research_idea=research_idea,
+                provider=provider,
+                model_name=model_name or "unknown",
+                raw_output="".join(raw_output_parts),
+                extracted_hypotheses=extracted_hypotheses,
+                extraction_stats=extraction_stats,
+                tool_interactions=tool_interactions
+            )
+            print(f"[{index}/{len(jobs)}] {domain}: {len(extracted_hypotheses)} hypotheses -> {session_file}")
+            return session_file
+    
+    results = await asyncio.gather(
+        *(run_job(i, *job) for i, job in enumerate(jobs, 1)),
+        return_exceptions=True
+    )
+    session_files = []
+    for (domain, _, _), result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            print(f"⚠️  Warning: Batch job for {domain} failed: {result}")
+            result = None
+        session_files.append(result)
+    return session_files
+
+
+def load_jobs(path):
+    """
+    Read batch jobs from a JSONL file.
+    
+    Each line is an object with "domain", "num_hypotheses" and "research_idea".
+    """
+    jobs = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            job = orjson.loads(line)
+            jobs.append((job["domain"], int(job["num_hypotheses"]), job["research_idea"]))
+    return jobs
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    settings = get_settings()
+    # Debug tracing of tool pairing is off unless LOG_LEVEL=DEBUG; other libraries stay at WARNING
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    logger.setLevel(settings.log_level or "WARNING")
+    if len(sys.argv) > 1:
+        # Batch mode: python openai_agent.py jobs.jsonl
+        asyncio.run(run_batch(load_jobs(sys.argv[1]),
+                              concurrency=settings.batch_concurrency))
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -2,16 +2,27 @@
 Shared tools module for both Claude and OpenAI Agent SDKs.
 """
 
-import os
-from agents import Agent, WebSearchTool, Runner  
+import time
+import logging
+import random
+import sqlite3
+import asyncio
+import functools
+import operator
+from array import array
+from contextlib import closing
+from pathlib import Path
+from agents import Agent, WebSearchTool, Runner, function_tool, FunctionTool
+from openai import AsyncOpenAI
 import datetime
+from config import get_settings
 
-literature_search_model = os.getenv("LITERATURE_SEARCH_MODEL", "gpt-5")
+logger = logging.getLogger(__name__)
 
-# Literature search agent with enhanced prompt and configurable model
-literature_agent = Agent(  
-    name="Literature Search Agent",  
-    instructions="""You are an expert academic research assistant specialized in finding scholarly literature and research papers.
+literature_search_model = get_settings().literature_model
+
+# Literature search agent instructions
+LITERATURE_AGENT_INSTRUCTIONS = """You are an expert academic research assistant specialized in finding scholarly literature and research papers.
     You search the most recent academic literature and provide detailed answers and citations. 
     Focus your research on the last 18 months. 
     The date today is 15th October, 2025.
@@ -27,7 +38,220 @@ For each source, provide:
 
 Be thorough but concise. Prioritize authoritative sources and recent work.
 
-""",
-    tools=[WebSearchTool()],
-    model=literature_search_model
-)
\ No newline at end of file
+"""
+
+
+@functools.cache
+def get_literature_agent() -> Agent:
+    """Build the literature search agent (with its web search tool) on first use and reuse it after."""
+    return Agent(
+        name="Literature Search Agent",
+        instructions=LITERATURE_AGENT_INSTRUCTIONS,
+        tools=[WebSearchTool()],
+        model=literature_search_model
+    )
+
+
+
+class CachedLiteratureTool:
+    """
+    Semantic cache in front of the literature search agent.
+    
+    Each query is embedded and bucketed with a 64-bit random-projection LSH
+    signature. Cached queries whose signature is within a small Hamming distance
+    are compared by cosine similarity, and a match at or above the threshold
+    returns the stored answer instead of running a new search. Entries persist
+    in SQLite with least-recently-used eviction, are scoped to the search model
+    that produced them, and expire max_age_s after they were first stored (hits
+    don't extend that), so answers to "recent literature" questions age out.
+    """
+    
+    SIGNATURE_BITS = 64
+    MAX_HAMMING_DISTANCE = 16  # ~cosine 0.7; exact cosine decides among candidates
+    SCHEMA_VERSION = 2  # Bumped when the table layout changes; older tables are dropped
+    
+    def __init__(self, agent_factory, db_path=".cache/litsearch.sqlite", threshold=0.92,
+                 max_entries=1000, embedding_model="text-embedding-3-small", enabled=True,
+                 model_name="", max_age_s=7 * 86400.0):
+        """
+        Initialize the cache.
+        
+        Args:
+            agent_factory: Zero-argument callable returning the literature search
+                agent to run on cache misses; only called when a search first runs
+            db_path: SQLite file used to persist cached answers
+            threshold: Minimum cosine similarity for a cache hit
+            max_entries: Entries kept before least-recently-used eviction
+            embedding_model: OpenAI embedding model used for query keys
+            enabled: When False, every call goes straight to the agent
+            model_name: Search model the answers come from; part of the cache key
+            max_age_s: Seconds after creation when an entry stops being served
+        """
+        self._agent_factory = agent_factory
+        self.db_path = Path(db_path)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.embedding_model = embedding_model
+        self.enabled = enabled
+        self.model_name = model_name
+        self.max_age_s = max_age_s
+        self._client = None
+        self._planes = None
+    
+    @property
+    def agent(self) -> Agent:
+        """The literature search agent, constructed on first access."""
+        return self._agent_factory()
+    
+    async def search(self, query: str) -> str:
+        """Answer a query from the cache when a similar one was seen, otherwise run the agent."""
+        if not self.enabled:
+            return (await Runner.run(self.agent, query)).final_output
+        
+        try:
+            embedding = await self._embed(query)
+            # Signature projection is pure-Python math, so it runs in the worker thread too
+            signature, cached = await asyncio.to_thread(self._lookup, embedding)
+        except Exception as e:
+            # Caching is best-effort; never fail the search because of it
+            logger.warning("Literature cache unavailable, searching directly: %s", e)
+            return (await Runner.run(self.agent, query)).final_output
+        
+        if cached is not None:
+            return cached
+        
+        answer = (await Runner.run(self.agent, query)).final_output
+        try:
+            await asyncio.to_thread(self._store, signature, query, embedding, answer)
+        except Exception as e:
+            logger.warning("Failed to cache literature search result: %s", e)
+        return answer
+    
+    def as_tool(self, tool_name: str, tool_description: str) -> FunctionTool:
+        """Expose the cached search as a single-query function tool."""
+        async def run_search(query: str) -> str:
+            """
+            Search the literature for a single question.
+            
+            Args:
+                query: A detailed research question.
+            """
+            return await self.search(query)
+        
+        return function_tool(run_search, name_override=tool_name, description_override=tool_description)
+    
+    async def _embed(self, query: str) -> list:
+        """Embed a query and normalize it so cosine similarity is a dot product."""
+        if self._client is None:
+            self._client = AsyncOpenAI()
+        response = await self._client.embeddings.create(model=self.embedding_model, input=query)
+        vector = response.data[0].embedding
+        norm = sum(map(operator.mul, vector, vector)) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+    
+    def _signature(self, embedding: list) -> int:
+        """Random-projection LSH: one bit per hyperplane, set when the vector lies on its positive side."""
+        if self._planes is None or len(self._planes[0]) != len(embedding):
+            # Fixed seed keeps signatures stable across processes sharing the same database
+            rng = random.Random(0)
+            self._planes = [[rng.gauss(0.0, 1.0) for _ in embedding] for _ in range(self.SIGNATURE_BITS)]
+        signature = 0
+        for bit, plane in enumerate(self._planes):
+            if sum(map(operator.mul, plane, embedding)) >= 0:
+                signature |= 1 << bit
+        return signature
+    
+    def _connect(self) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_path)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+            # Cached answers are disposable, so an outdated layout is simply rebuilt
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS literature_cache")
+                conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS literature_cache ("
+            "id INTEGER PRIMARY KEY, model TEXT NOT NULL, signature INTEGER NOT NULL, "
+            "query TEXT NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        # Hamming distance between two signed 64-bit signatures
+        conn.create_function(
+            "hamming", 2, lambda a, b: ((a ^ b) & 0xFFFFFFFFFFFFFFFF).bit_count(), deterministic=True
+        )
+        return conn
+    
+    @staticmethod
+    def _signed(signature: int) -> int:
+        """Map an unsigned 64-bit signature onto SQLite's signed 64-bit integers."""
+        return signature - (1 << 64) if signature >= (1 << 63) else signature
+    
+    def _lookup(self, embedding: list):
+        """Return (signature, cached answer for the most similar live stored query or None)."""
+        signature = self._signed(self._signature(embedding))
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            # One query; embeddings and answers are only read for rows within the Hamming radius
+            rows = conn.execute(
+                "SELECT id, embedding, response FROM literature_cache "
+                "WHERE model = ? AND created_at >= ? AND hamming(signature, ?) <= ?",
+                (self.model_name, now - self.max_age_s, signature, self.MAX_HAMMING_DISTANCE)
+            )
+            
+            best_id, best_response, best_score = None, None, self.threshold
+            for row_id, blob, response in rows:
+                score = sum(map(operator.mul, array('f', blob), embedding))
+                if score >= best_score:
+                    best_id, best_response, best_score = row_id, response, score
+            
+            if best_id is not None:
+                conn.execute("UPDATE literature_cache SET last_used = ? WHERE id = ?", (now, best_id))
+            return signature, best_response
+    
+    def _store(self, signature: int, query: str, embedding: list, response: str):
+        """Insert a new entry (signature as returned by _lookup), drop expired ones and evict the least recently used beyond max_entries."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO literature_cache (model, signature, query, embedding, response, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.model_name, signature, query, array('f', embedding).tobytes(), response, now, now)
+            )
+            conn.execute("DELETE FROM literature_cache WHERE created_at < ?", (now - self.max_age_s,))
+            conn.execute(
+                "DELETE FROM literature_cache WHERE id NOT IN "
+                "(SELECT id FROM literature_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+
+# Shared cache used by both literature search tools
+cached_literature_search = CachedLiteratureTool(
+    get_literature_agent,
+    threshold=get_settings().literature_cache_threshold,
+    enabled=get_settings().literature_cache,
+    model_name=literature_search_model,
+    max_age_s=get_settings().literature_cache_max_age_days * 86400,
+)
+
+
+@function_tool
+async def literature_search_batch(queries: list[str]) -> str:
+    """
+    Search for academic and scholarly information on several independent questions at once.
+    The queries run concurrently, so a batch takes about as long as its slowest query.
+
+    Args:
+        queries: Detailed research questions, one per entry.
+    """
+    results = await asyncio.gather(
+        *(cached_literature_search.search(query) for query in queries),
+        return_exceptions=True
+    )
+    
+    # One section per query, in the order given
+    sections = []
+    for index, (query, result) in enumerate(zip(queries, results), start=1):
+        answer = f"Search failed: {result}" if isinstance(result, Exception) else result
+        sections.append(f"## Query {index}: {query}\n\n{answer}")
+    return "\n\n".join(sections)